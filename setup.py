@@ -15,11 +15,15 @@ setup(
         "beautifulsoup4>=4.9.1,<5",
         "click>=7.1.2,<8",
         "click-log>=0.3.2,<1",
+        "lxml>=4.5.0,<5",
+        "orjson>=3.3.0,<4",
         "psycopg2>=2.8.5,<3",
         "pynacl>=1.4.0,<2",
         "pyotp>=2.3.0,<3",
         "requests>=2.24.0,<3",
+        "soupsieve>=2.0,<3",
         "tabulate>=0.8.7,<1",
+        "urllib3>=1.26,<3",
     ],
     setup_requires=["setuptools_scm"],
     use_scm_version=True,
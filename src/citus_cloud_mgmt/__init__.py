@@ -1,16 +1,21 @@
+import concurrent.futures as _concurrent_futures
+import functools as _functools
+import hashlib as _hashlib
+import html as _html
 import logging as _logging
+import os as _os
 import pathlib as _pathlib
 import pickle as _pickle
+import re as _re
+import struct as _struct
+import time as _time
 import typing as _tp
 from dataclasses import dataclass as _dataclass
 
 import atomicwrites as _atomicwrites
-import bs4 as _bs4
-import nacl.pwhash as _nacl_pwhash
-import nacl.secret as _nacl_secret
-import nacl.utils as _nacl_utils
-import pyotp as _pyotp
+import orjson as _orjson
 import requests as _requests
+import urllib3 as _urllib3
 
 try:
     __version__ = __import__("pkg_resources").get_distribution(__name__).version
@@ -31,11 +36,97 @@ def citus_console_url(path: str) -> str:
 SIGNIN_URL = citus_console_url("users/sign_in")
 FORMATIONS_URL = citus_console_url("formations")
 
-_PWHASH = _nacl_pwhash.scrypt
+
+def _nacl() -> _tp.Tuple[_tp.Any, _tp.Any, _tp.Any]:
+    # pynacl's CFFI binding takes tens of ms to load; only pay for it on
+    # the code paths that actually touch the cookie jar
+    import nacl.pwhash
+    import nacl.secret
+    import nacl.utils
+    return nacl.pwhash.scrypt, nacl.secret, nacl.utils
+
+
+# the root key is derived from credentials with a fixed application salt,
+# so it only has to be computed once per process
+_APP_SALT = _hashlib.sha256(APPNAME.encode()).digest()
+
+# per-file randomizer fed into the keyed-blake2b subkey derivation
+_SUBKEY_INFO_BYTES = _hashlib.blake2b.SALT_SIZE
+
+# cookie file header: format version plus the scrypt parameters the root
+# key was derived with, so files written with other settings still decode
+_COOKIES_FORMAT = 1
+_COOKIES_HEADER = _struct.Struct("<BQQ")
+
+# connect/read timeouts for every console request; a stalled TCP
+# connection should fail fast instead of hanging the CLI forever
+_TIMEOUT = (3, 10)
+
+# the console pages we scrape are machine-generated, so single-purpose
+# regexes over the raw bytes beat a full DOM parse; the precompiled CSS
+# selectors below back them up if the markup ever stops matching
+_CSRF_META_RE = _re.compile(rb'<meta[^>]+name="csrf-token"[^>]+content="([^"]+)"')
+_HIDDEN_INPUT_RE = _re.compile(rb'<input[^>]+type="hidden"[^>]+name="([^"]+)"[^>]+value="([^"]*)"')
+_BODY_RE = _re.compile(rb"<body[^>]*>(.*?)</body>", _re.DOTALL)
+
+
+@_functools.lru_cache(maxsize=None)
+def _sel(css: str) -> _tp.Any:
+    # soupsieve drags bs4 in with it; both are only needed on the
+    # fallback path, and each selector is still compiled just once
+    import soupsieve
+    return soupsieve.compile(css)
+
+
+def _find_csrf_token(content: bytes) -> str:
+    m = _CSRF_META_RE.search(content)
+    if m:
+        return m.group(1).decode()
+
+    import bs4 as _bs4
+
+    tag = _sel('meta[name="csrf-token"]').select_one(_bs4.BeautifulSoup(content, "lxml"))
+    assert tag
+    result = tag.attrs["content"]
+    assert isinstance(result, str)
+    return result
+
+
+def _find_signin_params(content: bytes) -> _tp.Dict[str, str]:
+    result = {
+        name.decode(): value.decode()
+        for name, value in _HIDDEN_INPUT_RE.findall(content)
+    }
+
+    if not result:
+        import bs4 as _bs4
+
+        for i in _sel('form#new_user input[type="hidden"]').select(_bs4.BeautifulSoup(content, "lxml")):
+            result[i.attrs["name"]] = i.attrs["value"]
+
+    assert result
+    return result
+
+
+class _NoSyncAtomicWriter(_atomicwrites.AtomicWriter):
+    """
+    Atomic replace without fsync of the file or its directory. The cookie
+    jar is a cache that re-login regenerates, so power-loss durability is
+    not worth the sync cost on every save.
+    """
+
+    def sync(self, f: _tp.IO[bytes]) -> None:
+        f.flush()
+
+    def commit(self, f: _tp.IO[bytes]) -> None:
+        _os.replace(f.name, self._path)
 
 
 @_dataclass
 class RoleInfo:
+    # no per-instance __dict__; formations can have many roles
+    __slots__ = ("name", "id_")
+
     name: str
     id_: str
 
@@ -46,6 +137,8 @@ class CitusCloudMgmt:
     password: str
     totp_secret: str
     cookies_path: _tp.Optional[_pathlib.Path]
+    opslimit: _tp.Optional[int]
+    memlimit: _tp.Optional[int]
 
     def __init__(
         self,
@@ -54,59 +147,169 @@ class CitusCloudMgmt:
         password: str,
         totp_secret: str,
         cookies_path_prefix: _tp.Optional[str] = None,
+        opslimit: _tp.Optional[int] = None,
+        memlimit: _tp.Optional[int] = None,
     ) -> None:
         self.logged_in = False
         self.user = user
         self.password = password
         self.totp_secret = totp_secret
+        self.opslimit = opslimit
+        self.memlimit = memlimit
 
         if cookies_path_prefix is None:
             self.cookies_path = None
         else:
             self.cookies_path = _pathlib.Path(cookies_path_prefix + user)
 
+        self._root_keys: _tp.Dict[_tp.Tuple[int, int], bytes] = {}
+        self._csrf_tokens: _tp.Dict[str, str] = {}
+        self._totp: _tp.Any = None
+        self._save_executor = _concurrent_futures.ThreadPoolExecutor(max_workers=1)
+        self._pending_save: _tp.Optional["_concurrent_futures.Future[None]"] = None
         self._session = _requests.Session()
+        self._session.headers["Connection"] = "keep-alive"
+        self._session.mount(
+            "https://",
+            _requests.adapters.HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=16,
+                pool_block=True,
+                max_retries=_urllib3.util.retry.Retry(
+                    total=3,
+                    backoff_factor=0.3,
+                    status_forcelist=[502, 503, 504],
+                    allowed_methods=frozenset(["GET", "POST", "DELETE"]),
+                ),
+            ),
+        )
         self._load_cookies()
+        self._saved_cookies_state = self._cookies_state()
+
+    def close(self) -> None:
+        self._save_executor.shutdown(wait=True)
+        if self._pending_save is not None:
+            # surface any error from the last background save
+            self._pending_save.result()
+        if self._cookies_state() != self._saved_cookies_state:
+            # changes that arrived while a save was in flight
+            self._save_cookies()
+        self._session.close()
+
+    def __enter__(self) -> "CitusCloudMgmt":
+        return self
+
+    def __exit__(self, *exc_info: _tp.Any) -> None:
+        self.close()
+
+    def _cookies_state(self) -> _tp.Tuple[_tp.Any, ...]:
+        return tuple(sorted(
+            (c.domain, c.path, c.name, c.value, c.expires)
+            for c in self._session.cookies
+        ))
+
+    def _secret_box(
+        self,
+        info: bytes,
+        opslimit: int,
+        memlimit: int,
+    ) -> _tp.Any:
+        _pwhash, _nacl_secret, _ = _nacl()
+
+        assert len(info) == _SUBKEY_INFO_BYTES
+
+        root_key = self._root_keys.get((opslimit, memlimit))
+        if root_key is None:
+            root_key = _pwhash.kdf(
+                _nacl_secret.SecretBox.KEY_SIZE,
+                b''.join(i.encode() for i in [self.password, self.totp_secret]),
+                _APP_SALT,
+                opslimit=opslimit,
+                memlimit=memlimit,
+            )
+            self._root_keys[opslimit, memlimit] = root_key
+
+        key = _hashlib.blake2b(
+            digest_size=_nacl_secret.SecretBox.KEY_SIZE,
+            key=root_key,
+            salt=info,
+        ).digest()
+        return _nacl_secret.SecretBox(key)
+
+    def _decrypt_cookies(self, xblob: bytes) -> bytes:
+        if xblob[:1] == bytes([_COOKIES_FORMAT]):
+            if len(xblob) < _COOKIES_HEADER.size + _SUBKEY_INFO_BYTES:
+                raise ValueError("Truncated cookie file")
 
-    def _secret_box(self, salt: bytes) -> _nacl_secret.SecretBox:
-        assert len(salt) == _PWHASH.SALTBYTES
-        key = _PWHASH.kdf(
+            _, opslimit, memlimit = _COOKIES_HEADER.unpack_from(xblob)
+            xblob = xblob[_COOKIES_HEADER.size:]
+
+            info = xblob[:_SUBKEY_INFO_BYTES]
+            box = self._secret_box(info, opslimit, memlimit)
+            return box.decrypt(xblob[_SUBKEY_INFO_BYTES:])
+
+        # headerless file from an older version: a per-file scrypt salt
+        # followed by a SecretBox keyed directly by the scrypt output
+        _pwhash, _nacl_secret, _ = _nacl()
+
+        salt = xblob[:_pwhash.SALTBYTES]
+        key = _pwhash.kdf(
             _nacl_secret.SecretBox.KEY_SIZE,
             b''.join(i.encode() for i in [self.password, self.totp_secret]),
             salt,
-            opslimit=_PWHASH.OPSLIMIT_INTERACTIVE,
-            memlimit=_PWHASH.MEMLIMIT_INTERACTIVE,
+            opslimit=_pwhash.OPSLIMIT_INTERACTIVE,
+            memlimit=_pwhash.MEMLIMIT_INTERACTIVE,
         )
-        return _nacl_secret.SecretBox(key)
+        return _nacl_secret.SecretBox(key).decrypt(xblob[_pwhash.SALTBYTES:])
 
     def _load_cookies(self) -> None:
         if self.cookies_path and self.cookies_path.exists():
+            import nacl.exceptions
+
             xblob = self.cookies_path.read_bytes()
 
-            salt = xblob[:_PWHASH.SALTBYTES]
-            box = self._secret_box(salt)
-            blob = box.decrypt(xblob[_PWHASH.SALTBYTES:])
+            try:
+                jar = _pickle.loads(self._decrypt_cookies(xblob))
+            except (nacl.exceptions.CryptoError, _struct.error, ValueError, _pickle.UnpicklingError):
+                # corrupted file, changed credentials, or an old file whose
+                # random salt happens to start with the format byte; the jar
+                # is a recreatable cache, so start empty and re-login
+                _logger.warning("Could not decode cookies from %s; ignoring them", self.cookies_path)
+                return
 
-            jar = _pickle.loads(blob)
             self._session.cookies.update(jar)
             _logger.debug("Loaded cookies from %s", self.cookies_path)
 
     def _save_cookies(self) -> None:
         if self.cookies_path:
-            blob = _pickle.dumps(self._session.cookies)
-
-            salt = _nacl_utils.random(_PWHASH.SALTBYTES)
-            box = self._secret_box(salt)
-            xblob = salt + box.encrypt(blob)
+            state = self._cookies_state()
+            blob = _pickle.dumps(self._session.cookies, protocol=_pickle.HIGHEST_PROTOCOL)
+            self._write_cookies(blob, state)
+
+    def _write_cookies(self, blob: bytes, state: _tp.Tuple[_tp.Any, ...]) -> None:
+        _pwhash, _, _nacl_utils = _nacl()
+
+        opslimit = self.opslimit if self.opslimit is not None else _pwhash.OPSLIMIT_MIN
+        memlimit = self.memlimit if self.memlimit is not None else _pwhash.MEMLIMIT_MIN
+
+        info = _nacl_utils.random(_SUBKEY_INFO_BYTES)
+        box = self._secret_box(info, opslimit, memlimit)
+        xblob = (
+            _COOKIES_HEADER.pack(_COOKIES_FORMAT, opslimit, memlimit)
+            + info
+            + box.encrypt(blob)
+        )
 
-            with _atomicwrites.atomic_write(
-                str(self.cookies_path),
-                mode="wb",
-                overwrite=True,
-            ) as f:
-                f.write(xblob)
+        with _atomicwrites.atomic_write(
+            str(self.cookies_path),
+            writer_cls=_NoSyncAtomicWriter,
+            mode="wb",
+            overwrite=True,
+        ) as f:
+            f.write(xblob)
 
-            _logger.debug("Saved cookies to %s", self.cookies_path)
+        self._saved_cookies_state = state
+        _logger.debug("Saved cookies to %s", self.cookies_path)
 
     def _request(
         self,
@@ -116,69 +319,99 @@ class CitusCloudMgmt:
         headers: _tp.Optional[_tp.Dict[str, str]] = None,
         params: _tp.Optional[_tp.Dict[str, str]] = None,
         json: _tp.Any = None,
+        stream: bool = False,
     ) -> _requests.Response:
         url = citus_console_url(path)
 
-        while True:
+        for _attempt in range(2):
             r = self._session.request(
                 method,
                 url,
                 headers=headers,
                 params=params,
                 json=json,
+                stream=stream,
+                timeout=_TIMEOUT,
             )
             r.raise_for_status()
 
             if r.url == url:
-                self._save_cookies()
+                if stream:
+                    # the caller only wants the status; don't pull the body
+                    r.close()
+                state = self._cookies_state()
+                if self.cookies_path and state != self._saved_cookies_state:
+                    # last-write-wins is fine for a cookie cache: if a save
+                    # is still in flight, the next changed response (or
+                    # close()) will pick up the newer jar
+                    if self._pending_save is None or self._pending_save.done():
+                        # snapshot the jar on this thread so the worker
+                        # never iterates it while new cookies land
+                        blob = _pickle.dumps(self._session.cookies, protocol=_pickle.HIGHEST_PROTOCOL)
+                        self._pending_save = self._save_executor.submit(self._write_cookies, blob, state)
                 return r
 
             if r.url == SIGNIN_URL:
                 _logger.debug("Signing into Citus Console")
 
-                soup = _bs4.BeautifulSoup(r.text, "html.parser")
-                form = soup.find("form", {"id": "new_user"})
-                assert form
-
-                signin_params = {}
-
-                for i in form.find_all("input", {"type": "hidden"}):
-                    signin_params[i.attrs["name"]] = i.attrs["value"]
+                signin_params = _find_signin_params(r.content)
 
                 signin_params["user[email]"] = self.user
                 signin_params["user[password]"] = self.password
 
                 #######################################################################
 
-                r = self._session.post(SIGNIN_URL, params=signin_params)
-                r.raise_for_status()
+                r = self._session.post(SIGNIN_URL, params=signin_params, stream=True, timeout=_TIMEOUT)
+                try:
+                    r.raise_for_status()
+
+                    if not r.url.startswith(SIGNIN_URL + "?"):
+                        raise RuntimeError(f"Unexpected redirect from sign-in #1 to {r.url}")
 
-                if not r.url.startswith(SIGNIN_URL + "?"):
-                    raise RuntimeError(f"Unexpected redirect from sign-in #1 to {r.url}")
+                    # the csrf meta tag and the 2FA marker both sit near the
+                    # top of the page; no need to pull the rest of the body
+                    head = r.raw.read(8192, decode_content=True)
+                finally:
+                    r.close()
 
-                soup = _bs4.BeautifulSoup(r.text, "html.parser")
-                assert soup.find("div", {"data-react-class": "TwoFAWidget"})
+                assert b"TwoFAWidget" in head
 
-                auth_token = soup.find("meta", {"name": "csrf-token"}).attrs["content"]
+                auth_token = _find_csrf_token(head)
+
+                if self._totp is None:
+                    import pyotp as _pyotp
+
+                    self._totp = _pyotp.TOTP(self.totp_secret)
+
+                # a code sent in the last moments of its 30-second window
+                # can expire in flight; wait out the remainder instead
+                remaining = 30 - _time.time() % 30
+                if remaining < 2:
+                    _time.sleep(remaining)
 
                 signin_params = {}
-                signin_params["user[otp_attempt]"] = _pyotp.TOTP(self.totp_secret).now()
+                signin_params["user[otp_attempt]"] = self._totp.now()
                 signin_params["authenticity_token"] = auth_token
 
                 #######################################################################
 
                 _logger.debug("Sending 2FA token")
 
-                r = self._session.post(SIGNIN_URL, params=signin_params)
+                r = self._session.post(SIGNIN_URL, params=signin_params, timeout=_TIMEOUT)
                 r.raise_for_status()
 
                 if r.url == FORMATIONS_URL or r.url == url:
                     _logger.debug("Successfully signed into Citus Console")
+                    # authentication rotates the session, so any tokens
+                    # scraped before it are stale
+                    self._csrf_tokens.clear()
                     continue
 
                 raise RuntimeError(f"Unexpected redirect from sign-in #2 to {r.url}")
             else:
                 raise RuntimeError(f"Unexpected redirect to {r.url}")
+        else:
+            raise RuntimeError("Sign-in retry limit exceeded")
 
     def login(self) -> None:
         self._request("get", "formations")
@@ -187,10 +420,11 @@ class CitusCloudMgmt:
         self,
         path: str,
     ) -> str:
-        r = self._request("get", path, headers={"Accept": "text/html"})
-        soup = _bs4.BeautifulSoup(r.text, "html.parser")
-        result = soup.find("meta", {"name": "csrf-token"}).attrs["content"]
-        assert isinstance(result, str)
+        result = self._csrf_tokens.get(path)
+        if result is None:
+            r = self._request("get", path, headers={"Accept": "text/html"})
+            result = _find_csrf_token(r.content)
+            self._csrf_tokens[path] = result
         return result
 
     def list_roles(
@@ -198,10 +432,9 @@ class CitusCloudMgmt:
         formation: str,
     ) -> _tp.List[RoleInfo]:
         path = f"formations/{formation}"
-        self._get_csrf_token(path)
 
         r = self._request("get", path, headers={"Accept": "application/json"})
-        data = r.json()
+        data = _orjson.loads(r.content)
         return [
             RoleInfo(name=i["name"], id_=i["id"])
             for i in data["roles"]
@@ -221,8 +454,9 @@ class CitusCloudMgmt:
             json={"role_name": name},
             headers={"Accept": "application/json", "X-CSRF-Token": auth_token},
         )
+        self._csrf_tokens.pop(path, None)
 
-        data = r.json()
+        data = _orjson.loads(r.content)
         result = data["id"]
         assert isinstance(result, str)
 
@@ -244,7 +478,9 @@ class CitusCloudMgmt:
             "delete",
             f"{path}/roles/{id_}",
             headers={"X-CSRF-Token": auth_token},
+            stream=True,
         )
+        self._csrf_tokens.pop(path, None)
 
     def get_role_credentials(
         self,
@@ -255,10 +491,9 @@ class CitusCloudMgmt:
 
         r = self._request("get", path)
 
-        soup = _bs4.BeautifulSoup(r.text, "html.parser")
-        body = soup.find("body")
-        assert body
-        assert len(body.contents) == 1
-        assert isinstance(body.contents[0], _bs4.element.NavigableString)
+        m = _BODY_RE.search(r.content)
+        assert m
+        body = m.group(1).strip()
+        assert b"<" not in body
 
-        return _tp.cast(str, body.contents[0].strip())
+        return _html.unescape(body.decode())
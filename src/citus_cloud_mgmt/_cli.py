@@ -1,17 +1,21 @@
 import functools
 import logging
+import os
 import typing as tp
 
 import citus_cloud_mgmt
 import click
 import click_log
-import tabulate
 
 from . import CitusCloudMgmt
+from . import RoleInfo
+
+# configure the package-level logger; this module's logger is a child of
+# it, so CLI messages and library debug output share the click_log handler
+lib_logger = logging.getLogger(citus_cloud_mgmt.__name__)
+click_log.basic_config(lib_logger)
 
 logger = logging.getLogger(__name__)
-click_log.basic_config(logger)
-citus_cloud_mgmt._logger = logger
 
 
 def click_wrapper(wrapper: tp.Callable[..., None], wrapped: tp.Callable[..., None]) -> tp.Callable[..., None]:
@@ -23,45 +27,117 @@ def click_wrapper(wrapper: tp.Callable[..., None], wrapped: tp.Callable[..., Non
 
 
 def base_command(func: tp.Callable[..., None]) -> tp.Callable[..., None]:
-    @click_log.simple_verbosity_option(logger)  # type: ignore
+    @click_log.simple_verbosity_option(lib_logger)  # type: ignore
     def wrapper(**opts: tp.Any) -> None:
         func(**opts)
 
     return click_wrapper(wrapper, func)
 
 
-def client_command(func: tp.Callable[..., None]) -> tp.Callable[..., None]:
-    @base_command
-    @click.option(
-        "--user", "-u",
-        envvar="CITUS_CLOUD_USER",
+def client_options(func: tp.Callable[..., None]) -> tp.Callable[..., None]:
+    func = click.option(
+        "--cookies",
+        help="Prefix for files to store cookies.",
+    )(func)
+    func = click.option(
+        "--totp", "-t",
+        envvar="CITUS_CLOUD_TOTP_SECRET",
         required=True,
-        help="Citus Cloud user email.",
-    )
-    @click.option(
+        help="Citus Cloud TOTP 2FA secret.",
+    )(func)
+    func = click.option(
         "--password", "-p",
         envvar="CITUS_CLOUD_PASSWORD",
         required=True,
         help="Citus Cloud user password.",
-    )
-    @click.option(
-        "--totp", "-t",
-        envvar="CITUS_CLOUD_TOTP_SECRET",
+    )(func)
+    func = click.option(
+        "--user", "-u",
+        envvar="CITUS_CLOUD_USER",
         required=True,
-        help="Citus Cloud TOTP 2FA secret.",
-    )
-    @click.option(
-        "--cookies",
-        help="Prefix for files to store cookies.",
+        help="Citus Cloud user email.",
+    )(func)
+    return func
+
+
+def local_client(opts: tp.Mapping[str, tp.Any]) -> CitusCloudMgmt:
+    return CitusCloudMgmt(
+        user=opts["user"],
+        password=opts["password"],
+        totp_secret=opts["totp"],
+        cookies_path_prefix=opts["cookies"],
     )
+
+
+_DAEMON_METHODS = frozenset([
+    "login",
+    "list_roles",
+    "create_role",
+    "delete_role",
+    "get_role_credentials",
+])
+
+
+class _DaemonClient:
+    """
+    Stand-in for CitusCloudMgmt that forwards each call to a running
+    ``daemon`` subcommand over its Unix socket, one JSON line per call.
+    """
+
+    def __init__(self, socket_path: str) -> None:
+        self._socket_path = socket_path
+
+    def _call(self, method: str, *args: str) -> tp.Any:
+        import json
+        import socket
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self._socket_path)
+            with sock.makefile("rw", encoding="utf-8") as f:
+                f.write(json.dumps({"method": method, "args": list(args)}) + "\n")
+                f.flush()
+                reply = json.loads(f.readline())
+
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+        return reply["result"]
+
+    def login(self) -> None:
+        self._call("login")
+
+    def list_roles(self, formation: str) -> tp.List[RoleInfo]:
+        return [
+            RoleInfo(name=i["name"], id_=i["id_"])
+            for i in self._call("list_roles", formation)
+        ]
+
+    def create_role(self, formation: str, name: str) -> str:
+        result = self._call("create_role", formation, name)
+        assert isinstance(result, str)
+        return result
+
+    def delete_role(self, formation: str, id_: str) -> None:
+        self._call("delete_role", formation, id_)
+
+    def get_role_credentials(self, formation: str, id_: str) -> str:
+        result = self._call("get_role_credentials", formation, id_)
+        assert isinstance(result, str)
+        return result
+
+
+def client_command(func: tp.Callable[..., None]) -> tp.Callable[..., None]:
+    @base_command
+    @client_options
     def wrapper(**opts: tp.Any) -> None:
-        client = CitusCloudMgmt(
-            user=opts["user"],
-            password=opts["password"],
-            totp_secret=opts["totp"],
-            cookies_path_prefix=opts["cookies"],
-        )
-        func(client, **opts)
+        socket_path = os.environ.get("CITUS_CLOUD_DAEMON_SOCK")
+
+        if socket_path:
+            func(_DaemonClient(socket_path), **opts)
+        else:
+            # close() flushes pending cookie saves and surfaces any
+            # error from the background save thread
+            with local_client(opts) as client:
+                func(client, **opts)
 
     return click_wrapper(wrapper, func)
 
@@ -104,6 +180,68 @@ def main_login(
     logger.info("successfully logged in")
 
 
+@main.command(name="daemon")
+@base_command
+@client_options
+@click.option(
+    "--socket", "-s",
+    envvar="CITUS_CLOUD_DAEMON_SOCK",
+    required=True,
+    help="Path of the Unix socket to listen on.",
+)
+def main_daemon(**opts: tp.Any) -> None:
+    """
+    Serve client calls from a long-lived process over a Unix socket.
+
+    Point CITUS_CLOUD_DAEMON_SOCK at the socket and other subcommands
+    forward to this process, reusing its session and cookies instead of
+    signing in per invocation.
+    """
+    import dataclasses
+    import json
+    import socketserver
+
+    client = local_client(opts)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            try:
+                request = json.loads(line)
+                method = request["method"]
+                if method not in _DAEMON_METHODS:
+                    raise RuntimeError(f"Unknown method \"{method}\"")
+
+                result = getattr(client, method)(*request["args"])
+                if method == "list_roles":
+                    result = [dataclasses.asdict(i) for i in result]
+                reply: tp.Dict[str, tp.Any] = {"result": result}
+            except Exception as e:  # noqa
+                logger.exception("Failed daemon call")
+                reply = {"error": f"{type(e).__name__}: {e}"}
+
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+    socket_path = opts["socket"]
+
+    try:
+        # a stale socket from an unclean exit would fail the bind
+        os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+
+    with socketserver.UnixStreamServer(socket_path, Handler) as server:
+        logger.info(f"Serving on \"{socket_path}\"")
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+            client.close()
+
+
 @main.group(name="role")
 def main_role(**opts: tp.Any) -> None:
     """
@@ -121,11 +259,13 @@ def main_role_list(
     List roles for given formation.
     """
 
+    import tabulate
+
     roles = client.list_roles(opts["formation"])
     click.echo(
         tabulate.tabulate(
-            [{"Name": i.name, "Id": i.id_} for i in roles],
-            headers="keys",
+            ((i.name, i.id_) for i in roles),
+            headers=["Name", "Id"],
         ),
     )
 